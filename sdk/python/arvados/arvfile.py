@@ -303,6 +303,10 @@ class _BufferBlock(object):
     ERROR = 3
     DELETED = 4
 
+    __slots__ = ("blockid", "buffer_block", "buffer_view", "write_pointer",
+                 "_state", "_locator", "owner", "lock", "wait_for_commit",
+                 "error")
+
     def __init__(self, blockid, starting_capacity, owner):
         """
         :blockid:
@@ -337,8 +341,13 @@ class _BufferBlock(object):
         if self._state == _BufferBlock.WRITABLE:
             if not isinstance(data, bytes) and not isinstance(data, memoryview):
                 data = data.encode()
-            while (self.write_pointer+len(data)) > len(self.buffer_block):
-                new_buffer_block = bytearray(len(self.buffer_block) * 2)
+            if (self.write_pointer+len(data)) > len(self.buffer_block):
+                # Compute the final capacity up front so the existing
+                # contents are copied only once, not once per doubling.
+                new_capacity = len(self.buffer_block) * 2
+                while (self.write_pointer+len(data)) > new_capacity:
+                    new_capacity *= 2
+                new_buffer_block = bytearray(new_capacity)
                 new_buffer_block[0:self.write_pointer] = self.buffer_block[0:self.write_pointer]
                 self.buffer_block = new_buffer_block
                 self.buffer_view = memoryview(self.buffer_block)
@@ -574,11 +583,14 @@ class _BlockManager(object):
                 # generating data more quickly than it can be send to the Keep
                 # servers.
                 #
-                # With two upload threads and a queue size of 2, this means up to 4
-                # blocks pending.  If they are full 64 MiB blocks, that means up to
-                # 256 MiB of internal buffering, which is the same size as the
-                # default download block cache in KeepClient.
-                self._put_queue = queue.Queue(maxsize=2)
+                # The queue is sized to match the number of upload threads, so
+                # there can be up to 2 blocks in flight per thread (one being
+                # uploaded, one queued).  With the default two upload threads
+                # and full 64 MiB blocks, that means up to 256 MiB of internal
+                # buffering, which is the same size as the default download
+                # block cache in KeepClient.  Asking for more threads raises
+                # the cap accordingly.
+                self._put_queue = queue.Queue(maxsize=self.num_put_threads)
 
                 self._put_threads = []
                 for i in range(0, self.num_put_threads):
@@ -679,7 +691,9 @@ class _BlockManager(object):
             bb = small_blocks.pop(0)
             new_bb.owner.append(bb.owner)
             self._pending_write_size -= bb.size()
-            new_bb.append(bb.buffer_view[0:bb.write_pointer].tobytes())
+            # append() copies from the memoryview straight into new_bb's
+            # buffer, so don't make an intermediate bytes copy here.
+            new_bb.append(bb.buffer_view[0:bb.write_pointer])
             files.append((bb, new_bb.write_pointer - bb.size()))
 
         self.commit_bufferblock(new_bb, sync=sync)
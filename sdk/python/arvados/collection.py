@@ -37,6 +37,9 @@ from arvados.retry import retry_method
 
 _logger = logging.getLogger('arvados.collection')
 
+# Non-portable locator hints: everything but the size hint.
+_non_portable_hints_re = re.compile(r'\+[^\d][^\+]*')
+
 
 if sys.version_info >= (3, 0):
     TextIOWrapper = io.TextIOWrapper
@@ -76,13 +79,13 @@ class CollectionBase(object):
         """
         raw = self.manifest_text()
         clean = []
+        locator_match = arvados.util.keep_locator_pattern.match
+        strip_hints = _non_portable_hints_re.sub
         for line in raw.split("\n"):
             fields = line.split()
             if fields:
                 clean_fields = fields[:1] + [
-                    (re.sub(r'\+[^\d][^\+]*', '', x)
-                     if re.match(arvados.util.keep_locator_pattern, x)
-                     else x)
+                    (strip_hints('', x) if locator_match(x) else x)
                     for x in fields[1:]]
                 clean += [' '.join(clean_fields), "\n"]
         return ''.join(clean)
@@ -292,14 +295,27 @@ class CollectionWriter(CollectionBase):
         return self._last_open
 
     def flush_data(self):
-        data_buffer = b''.join(self._data_buffer)
+        # Gather just enough buffered chunks to fill one Keep block and
+        # leave the rest of the buffer untouched, instead of re-joining
+        # and re-slicing the whole buffer on every flush (which is
+        # quadratic when a write spans many blocks).
+        chunks = deque(self._data_buffer)
+        block_chunks = []
+        block_len = 0
+        while chunks and block_len < config.KEEP_BLOCK_SIZE:
+            chunk = chunks.popleft()
+            still_need = config.KEEP_BLOCK_SIZE - block_len
+            if len(chunk) > still_need:
+                chunks.appendleft(chunk[still_need:])
+                chunk = chunk[:still_need]
+            block_chunks.append(chunk)
+            block_len += len(chunk)
+        data_buffer = b''.join(block_chunks)
         if data_buffer:
             self._current_stream_locators.append(
-                self._my_keep().put(
-                    data_buffer[0:config.KEEP_BLOCK_SIZE],
-                    copies=self.replication))
-            self._data_buffer = [data_buffer[config.KEEP_BLOCK_SIZE:]]
-            self._data_buffer_len = len(self._data_buffer[0])
+                self._my_keep().put(data_buffer, copies=self.replication))
+            self._data_buffer = list(chunks)
+            self._data_buffer_len -= len(data_buffer)
 
     def start_new_file(self, newfilename=None):
         self.finish_current_file()
@@ -391,17 +407,20 @@ class CollectionWriter(CollectionBase):
 
     def manifest_text(self):
         self.finish_current_stream()
-        manifest = ''
+        # Build the manifest in a buffer and join it once at the end:
+        # repeated str concatenation is quadratic on manifests with many
+        # streams.
+        manifest = []
 
         for stream in self._finished_streams:
             if not re.search(r'^\.(/.*)?$', stream[0]):
-                manifest += './'
-            manifest += stream[0].replace(' ', '\\040')
-            manifest += ' ' + ' '.join(stream[1])
-            manifest += ' ' + ' '.join("%d:%d:%s" % (sfile[0], sfile[1], sfile[2].replace(' ', '\\040')) for sfile in stream[2])
-            manifest += "\n"
+                manifest.append('./')
+            manifest.append(stream[0].replace(' ', '\\040'))
+            manifest.append(' ' + ' '.join(stream[1]))
+            manifest.append(' ' + ' '.join("%d:%d:%s" % (sfile[0], sfile[1], sfile[2].replace(' ', '\\040')) for sfile in stream[2]))
+            manifest.append("\n")
 
-        return manifest
+        return ''.join(manifest)
 
     def data_locators(self):
         ret = []
@@ -571,7 +571,7 @@ def total_collection_size(manifest_text):
     duplicate blocks)."""
 
     total_bytes = 0
-    locators_seen = {}
+    locators_seen = set()
     for line in manifest_text.splitlines():
         words = line.split()
         for word in words[1:]:
@@ -580,7 +580,7 @@ def total_collection_size(manifest_text):
             except ValueError:
                 continue  # this word isn't a locator, skip it
             if loc.md5sum not in locators_seen:
-                locators_seen[loc.md5sum] = True
+                locators_seen.add(loc.md5sum)
                 total_bytes += loc.size
 
     return total_bytes
@@ -3,7 +3,6 @@
 # SPDX-License-Identifier: Apache-2.0
 
 from __future__ import division
-from future.utils import listitems, listvalues
 from builtins import str
 from builtins import object
 import argparse
@@ -18,22 +17,68 @@ import fnmatch
 import hashlib
 import json
 import logging
+import mmap
 import os
 import pwd
 import re
 import signal
 import socket
+import struct
 import sys
 import tempfile
 import threading
 import time
 import traceback
+import zlib
 
 from apiclient import errors as apiclient_errors
 from arvados._version import __version__
 
 import arvados.commands._util as arv_cmd
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    # C-implemented serializer: emits/accepts bytes, much faster than the
+    # stdlib json module on the multi-megabyte states saved on every
+    # checkpoint.
+    def _json_loads(data):
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # Parse states saved through the _json_dumps fallback below,
+            # whose surrogate escapes orjson refuses to decode.
+            return json.loads(data)
+    def _json_dumps(obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson rejects surrogate-escaped strings, which is how the
+            # OS hands back filenames that aren't valid UTF-8; the stdlib
+            # serializer handles them fine.
+            return json.dumps(obj).encode()
+else:
+    _json_loads = json.loads
+    def _json_dumps(obj):
+        return json.dumps(obj).encode()
+
+if hasattr(hashlib, 'blake2b'):
+    def _cache_digest():
+        # BLAKE2b is faster than MD5 and works just as well for deriving
+        # cache file names; a 16 byte digest keeps the historical name
+        # length.
+        return hashlib.blake2b(digest_size=16)
+else:  # Python 2
+    def _cache_digest():
+        return hashlib.md5()
+
+# fdatasync() skips flushing file metadata, but isn't available everywhere
+# (e.g., OS X).
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
 api_client = None
 
 upload_opts = argparse.ArgumentParser(add_help=False)
@@ -277,6 +322,63 @@ def parse_arguments(arguments):
     return args
 
 
+class _FSEntry(object):
+    """Minimal os.DirEntry stand-in for platforms without os.scandir()."""
+    __slots__ = ('name', 'path')
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        return os.lstat(self.path)
+
+
+def _dir_walk(path, followlinks=False):
+    """Walk a directory tree like os.walk(topdown=True) does, but yield
+    os.DirEntry objects for files instead of bare names, so callers can
+    reuse the stat info fetched while scanning each directory instead of
+    issuing an extra stat() syscall per file.  Like os.walk, scan errors
+    are ignored and the subdirectory list can be modified in place to
+    prune the walk.
+    """
+    try:
+        if hasattr(os, 'scandir'):
+            entries = list(os.scandir(path))
+        else:
+            entries = [_FSEntry(path, name) for name in os.listdir(path)]
+    except OSError:
+        return
+    dir_entries = {}
+    file_entries = []
+    for ent in entries:
+        try:
+            is_dir = ent.is_dir()
+        except OSError:
+            # Same as os.walk: if is_dir() fails (e.g., a broken or
+            # circular symlink), treat the entry as a file.
+            is_dir = False
+        if is_dir:
+            dir_entries[ent.name] = ent
+        else:
+            file_entries.append(ent)
+    dirs = list(dir_entries.keys())
+    yield path, dirs, file_entries
+    for name in dirs:
+        ent = dir_entries[name]
+        if followlinks or not ent.is_symlink():
+            for walk_entry in _dir_walk(ent.path, followlinks):
+                yield walk_entry
+
+
 class PathDoesNotExistError(Exception):
     pass
 
@@ -332,25 +434,29 @@ class ArvPutLogFormatter(logging.Formatter):
 
 class ResumeCache(object):
     CACHE_DIR = '.cache/arvados/arv-put'
+    # Each checkpoint is prefixed with the payload length and crc32, so
+    # load() can reject a checkpoint that was cut short by a crash.
+    HEADER = struct.Struct('>II')
 
     def __init__(self, file_spec):
-        self.cache_file = open(file_spec, 'a+')
+        self.cache_file = os.fdopen(
+            os.open(file_spec, os.O_RDWR | os.O_CREAT, 0o666), 'r+b')
         self._lock_file(self.cache_file)
-        self.filename = self.cache_file.name
+        self.filename = file_spec
 
     @classmethod
     def make_path(cls, args):
-        md5 = hashlib.md5()
-        md5.update(arvados.config.get('ARVADOS_API_HOST', '!nohost').encode())
-        realpaths = sorted(os.path.realpath(path) for path in args.paths)
-        md5.update(b'\0'.join([p.encode() for p in realpaths]))
+        digest = _cache_digest()
+        digest.update(arvados.config.get('ARVADOS_API_HOST', '!nohost').encode())
+        realpaths = sorted(map(os.path.realpath, args.paths))
+        digest.update(b'\0'.join(p.encode() for p in realpaths))
         if any(os.path.isdir(path) for path in realpaths):
-            md5.update(b'-1')
+            digest.update(b'-1')
         elif args.filename:
-            md5.update(args.filename.encode())
+            digest.update(args.filename.encode())
         return os.path.join(
             arv_cmd.make_home_conf_dir(cls.CACHE_DIR, 0o700, 'raise'),
-            md5.hexdigest())
+            digest.hexdigest())
 
     def _lock_file(self, fileobj):
         try:
@@ -360,7 +466,14 @@ class ResumeCache(object):
 
     def load(self):
         self.cache_file.seek(0)
-        return json.load(self.cache_file)
+        header = self.cache_file.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            raise ValueError("cache file has no checkpoint header")
+        length, crc = self.HEADER.unpack(header)
+        serialized = self.cache_file.read(length)
+        if len(serialized) != length or (zlib.crc32(serialized) & 0xffffffff) != crc:
+            raise ValueError("cache file checkpoint is corrupt")
+        return _json_loads(serialized)
 
     def check_cache(self, api_client=None, num_retries=0):
         try:
@@ -380,21 +493,40 @@ class ResumeCache(object):
             pass
 
     def save(self, data):
+        serialized = _json_dumps(data)
+        checkpoint = self.HEADER.pack(
+            len(serialized), zlib.crc32(serialized) & 0xffffffff) + serialized
         try:
-            new_cache_fd, new_cache_name = tempfile.mkstemp(
-                dir=os.path.dirname(self.filename))
-            self._lock_file(new_cache_fd)
-            new_cache = os.fdopen(new_cache_fd, 'r+')
-            json.dump(data, new_cache)
-            os.rename(new_cache_name, self.filename)
-        except (IOError, OSError, ResumeCacheConflict) as error:
             try:
-                os.unlink(new_cache_name)
-            except NameError:  # mkstemp failed.
-                pass
-        else:
-            self.cache_file.close()
-            self.cache_file = new_cache
+                same = os.path.samestat(os.fstat(self.cache_file.fileno()),
+                                        os.stat(self.filename))
+            except OSError:
+                same = False
+            if not same:
+                # The cache file was deleted or replaced behind our back.
+                # Reclaim the path so our lock keeps covering it.
+                new_fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    self._lock_file(new_fd)
+                except ResumeCacheConflict:
+                    os.close(new_fd)
+                    return
+                self.cache_file.close()
+                self.cache_file = os.fdopen(new_fd, 'r+b')
+            fd = self.cache_file.fileno()
+            if hasattr(os, 'pwrite'):
+                os.pwrite(fd, checkpoint, 0)
+            else:  # Python 2
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, checkpoint)
+            os.ftruncate(fd, len(checkpoint))
+            # Make sure the checkpoint hits the disk before we report
+            # progress past it.
+            _fdatasync(fd)
+        except (IOError, OSError) as error:
+            # Leave the file as is: if the write was torn, load() will
+            # notice the crc32 mismatch and treat the cache as empty.
+            pass
 
     def close(self):
         self.cache_file.close()
@@ -449,6 +581,8 @@ class ArvPutUploadJob(object):
         self._state = None # Previous run state (file list & manifest)
         self._current_files = [] # Current run file list
         self._cache_file = None
+        self._saved_state_digest = None # Digest of the last checkpointed state
+        self._read_buffer = None # Block-sized buffer shared by non-mmap reads
         self._collection_lock = threading.Lock()
         self._remote_collection = None # Collection being updated (if asked)
         self._local_collection = None # Collection from previous run manifest
@@ -487,8 +621,7 @@ class ArvPutUploadJob(object):
         """
         # If there aren't special files to be read, reset total bytes count to zero
         # to start counting.
-        if not any([p for p in self.paths
-                    if not (os.path.isfile(p) or os.path.isdir(p))]):
+        if all(os.path.isfile(p) or os.path.isdir(p) for p in self.paths):
             self.bytes_expected = 0
 
         for path in self.paths:
@@ -514,8 +647,8 @@ class ArvPutUploadJob(object):
                     # upload the directory to the collection's root.
                     prefixdir = os.path.dirname(path)
                 prefixdir += os.sep
-                for root, dirs, files in os.walk(path,
-                                                 followlinks=self.follow_links):
+                for root, dirs, files in _dir_walk(path,
+                                                   followlinks=self.follow_links):
                     root_relpath = os.path.relpath(root, path)
                     if root_relpath == '.':
                         root_relpath = ''
@@ -527,25 +660,27 @@ class ArvPutUploadJob(object):
                                               for pat in self.exclude_paths)]
                         files = [f for f in files
                                  if not any(pathname_match(
-                                         os.path.join(root_relpath, f), pat)
+                                         os.path.join(root_relpath, f.name), pat)
                                             for pat in self.exclude_paths)]
                     # Exclude files/dirs by name matching pattern
                     if self.exclude_names is not None:
                         dirs[:] = [d for d in dirs
                                    if not self.exclude_names.match(d)]
                         files = [f for f in files
-                                 if not self.exclude_names.match(f)]
-                    # Make os.walk()'s dir traversing order deterministic
+                                 if not self.exclude_names.match(f.name)]
+                    # Make the dir traversing order deterministic
                     dirs.sort()
-                    files.sort()
+                    files.sort(key=lambda ent: ent.name)
                     for f in files:
-                        filepath = os.path.join(root, f)
+                        filepath = os.path.join(root, f.name)
                         # Add its size to the total bytes count (if applicable)
-                        if self.follow_links or (not os.path.islink(filepath)):
+                        if self.follow_links or (not f.is_symlink()):
                             if self.bytes_expected is not None:
-                                self.bytes_expected += os.path.getsize(filepath)
+                                self.bytes_expected += f.stat(
+                                    follow_symlinks=self.follow_links).st_size
                         self._check_file(filepath,
-                                         os.path.join(root[len(prefixdir):], f))
+                                         os.path.join(root[len(prefixdir):],
+                                                      f.name))
             else:
                 filepath = os.path.abspath(path)
                 # Add its size to the total bytes count (if applicable)
@@ -645,7 +780,7 @@ class ArvPutUploadJob(object):
         Recursively get the total size of the collection
         """
         size = 0
-        for item in listvalues(collection):
+        for item in collection.values():
             if isinstance(item, arvados.collection.Collection) or isinstance(item, arvados.collection.Subcollection):
                 size += self._collection_size(item)
             else:
@@ -786,11 +921,48 @@ class ArvPutUploadJob(object):
                 output.close(flush=False)
 
     def _write(self, source_fd, output):
-        while True:
-            data = source_fd.read(arvados.config.KEEP_BLOCK_SIZE)
-            if not data:
-                break
-            output.write(data)
+        readinto = getattr(source_fd, 'readinto', None)
+        if readinto is None:
+            # Text streams (e.g. stdin) don't support readinto().
+            while True:
+                data = source_fd.read(arvados.config.KEEP_BLOCK_SIZE)
+                if not data:
+                    break
+                output.write(data)
+            return
+        try:
+            mm = mmap.mmap(source_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, OverflowError, OSError,
+                EnvironmentError):
+            # Not a non-empty regular file (pipe, device, BytesIO, ...):
+            # stream it through a recycled read buffer, which the
+            # collection's buffer block copies (and hashes) chunk by chunk.
+            # Empty files land here too (mmap() refuses them), so only
+            # allocate the buffer once per upload, not per source.
+            if self._read_buffer is None:
+                self._read_buffer = bytearray(arvados.config.KEEP_BLOCK_SIZE)
+            buf = self._read_buffer
+            buf_view = memoryview(buf)
+            while True:
+                got = readinto(buf)
+                if not got:
+                    break
+                output.write(buf_view[:got])
+            return
+        # Regular file: feed the collection straight from the page cache.
+        # The buffer block copies each chunk as it's appended, so no
+        # intermediate read() copy is needed.
+        mm_view = memoryview(mm)
+        try:
+            pos = source_fd.tell()  # Honor resume offsets
+            size = len(mm)
+            while pos < size:
+                end = min(pos + arvados.config.KEEP_BLOCK_SIZE, size)
+                output.write(mm_view[pos:end])
+                pos = end
+        finally:
+            del mm_view
+            mm.close()
 
     def _my_collection(self):
         return self._remote_collection if self.update else self._local_collection
@@ -815,13 +987,13 @@ class ArvPutUploadJob(object):
 
         if self.use_cache:
             # Set up cache file name from input paths.
-            md5 = hashlib.md5()
-            md5.update(arvados.config.get('ARVADOS_API_HOST', '!nohost').encode())
-            realpaths = sorted(os.path.realpath(path) for path in self.paths)
-            md5.update(b'\0'.join([p.encode() for p in realpaths]))
+            digest = _cache_digest()
+            digest.update(arvados.config.get('ARVADOS_API_HOST', '!nohost').encode())
+            digest.update(b'\0'.join(
+                p.encode() for p in sorted(map(os.path.realpath, self.paths))))
             if self.filename:
-                md5.update(self.filename.encode())
-            cache_filename = md5.hexdigest()
+                digest.update(self.filename.encode())
+            cache_filename = digest.hexdigest()
             cache_filepath = os.path.join(
                 arv_cmd.make_home_conf_dir(self.CACHE_DIR, 0o700, 'raise'),
                 cache_filename)
@@ -839,7 +1011,7 @@ class ArvPutUploadJob(object):
         with self._state_lock:
             if self.use_cache:
                 try:
-                    self._state = json.load(self._cache_file)
+                    self._state = _json_loads(self._cache_file.read())
                     if not set(['manifest', 'files']).issubset(set(self._state.keys())):
                         # Cache at least partially incomplete, set up new cache
                         self._state = copy.deepcopy(self.EMPTY_STATE)
@@ -860,7 +1032,7 @@ class ArvPutUploadJob(object):
     def collection_file_paths(self, col, path_prefix='.'):
         """Return a list of file paths by recursively go through the entire collection `col`"""
         file_paths = []
-        for name, item in listitems(col):
+        for name, item in col.items():
             if isinstance(item, arvados.arvfile.ArvadosFile):
                 file_paths.append(os.path.join(path_prefix, name))
             elif isinstance(item, arvados.collection.Subcollection):
@@ -879,13 +1051,27 @@ class ArvPutUploadJob(object):
         Atomically save current state into cache.
         """
         with self._state_lock:
-            # We're not using copy.deepcopy() here because it's a lot slower
-            # than json.dumps(), and we're already needing JSON format to be
-            # saved on disk.
-            state = json.dumps(self._state)
+            # Take a shallow snapshot so the (possibly multi-megabyte)
+            # serialization happens outside the lock and doesn't stall
+            # uploader threads: the manifest string is immutable, but the
+            # per-file dicts must be copied because _check_file() and
+            # _upload_files() update them in place.
+            state_snapshot = {}
+            for k, v in self._state.items():
+                if k == 'files':
+                    state_snapshot[k] = {fname: fdata.copy()
+                                         for fname, fdata in v.items()}
+                else:
+                    state_snapshot[k] = v
+        state = _json_dumps(state_snapshot)
+        state_digest = hashlib.md5(state).hexdigest()
+        if state_digest == self._saved_state_digest:
+            # Nothing changed since the last checkpoint, skip the rewrite and
+            # its fsync+rename round trip.
+            return
         try:
             new_cache = tempfile.NamedTemporaryFile(
-                mode='w+',
+                mode='w+b',
                 dir=os.path.dirname(self._cache_filename), delete=False)
             self._lock_file(new_cache)
             new_cache.write(state)
@@ -899,6 +1085,7 @@ class ArvPutUploadJob(object):
             except NameError:  # mkstemp failed.
                 pass
         else:
+            self._saved_state_digest = state_digest
             self._cache_file.close()
             self._cache_file = new_cache
 
@@ -937,7 +1124,7 @@ class ArvPutUploadJob(object):
                     locators.append(loc)
                 return locators
         elif isinstance(item, arvados.collection.Collection):
-            l = [self._datablocks_on_item(x) for x in listvalues(item)]
+            l = [self._datablocks_on_item(x) for x in item.values()]
             # Fast list flattener method taken from:
             # http://stackoverflow.com/questions/952914/making-a-flat-list-out-of-list-of-lists-in-python
             return [loc for sublist in l for loc in sublist]
@@ -951,8 +1138,7 @@ class ArvPutUploadJob(object):
             datablocks = self._datablocks_on_item(self._my_collection())
         return datablocks
 
-_machine_format = "{} {}: {{}} written {{}} total\n".format(sys.argv[0],
-                                                            os.getpid())
+_machine_format = None
 
 # Simulate glob.glob() matching behavior without the need to scan the filesystem
 # Note: fnmatch() doesn't work correctly when used with pathnames. For example the
@@ -970,20 +1156,35 @@ def pathname_match(pathname, pattern):
     return True
 
 def machine_progress(bytes_written, bytes_expected):
+    global _machine_format
+    if _machine_format is None:
+        # Capture argv/pid on first use instead of at import time, so
+        # importing this module as a library doesn't bake in the importer's
+        # command line.
+        _machine_format = "{} {}: {{}} written {{}} total\n".format(
+            sys.argv[0], os.getpid())
     return _machine_format.format(
         bytes_written, -1 if (bytes_expected is None) else bytes_expected)
 
 def human_progress(bytes_written, bytes_expected):
+    # %-interpolation is measurably cheaper than str.format() and works on
+    # Python 2, where f-strings aren't available.
     if bytes_expected:
-        return "\r{}M / {}M {:.1%} ".format(
+        return "\r%dM / %dM %.1f%% " % (
             bytes_written >> 20, bytes_expected >> 20,
-            float(bytes_written) / bytes_expected)
+            100.0 * bytes_written / bytes_expected)
     else:
-        return "\r{} ".format(bytes_written)
+        return "\r%d " % bytes_written
 
 def progress_writer(progress_func, outfile=sys.stderr):
+    last_report = [None]
     def write_progress(bytes_written, bytes_expected):
-        outfile.write(progress_func(bytes_written, bytes_expected))
+        report = progress_func(bytes_written, bytes_expected)
+        # Skip the write when the rendered report didn't change since the
+        # last sample.
+        if report != last_report[0]:
+            outfile.write(report)
+            last_report[0] = report
     return write_progress
 
 def desired_project_uuid(api_client, project_uuid, num_retries):
@@ -1104,7 +1305,7 @@ def main(arguments=None, stdout=sys.stdout, stderr=sys.stderr,
 
     # If this is used by a human, and there's at least one directory to be
     # uploaded, the expected bytes calculation can take a moment.
-    if args.progress and any([os.path.isdir(f) for f in args.paths]):
+    if args.progress and any(os.path.isdir(f) for f in args.paths):
         logger.info("Calculating upload size, this could take some time...")
     try:
         writer = ArvPutUploadJob(paths = args.paths,
@@ -207,6 +207,36 @@ class ArvadosPutResumeCacheTest(ArvadosBaseTestCase):
         self.last_cache.save(thing)
         self.assertEqual(thing, self.last_cache.load())
 
+    def test_corrupt_cache_treated_as_empty(self):
+        with tempfile.NamedTemporaryFile() as cachefile:
+            self.last_cache = arv_put.ResumeCache(cachefile.name)
+        self.last_cache.save(['test', 'list'])
+        # Flip a payload byte, like a checkpoint torn by a crash.
+        with open(self.last_cache.filename, 'r+b') as f:
+            f.seek(arv_put.ResumeCache.HEADER.size)
+            f.write(b'\0')
+        self.assertRaises(ValueError, self.last_cache.load)
+
+    def test_cache_without_checkpoint_header_treated_as_empty(self):
+        # Caches written before the length+crc32 header was introduced
+        # hold bare JSON.
+        path = os.path.join(self.make_tmpdir(), 'cache')
+        with open(path, 'w') as f:
+            json.dump(['test', 'list'], f)
+        self.last_cache = arv_put.ResumeCache(path)
+        self.assertRaises(ValueError, self.last_cache.load)
+
+    def test_save_reclaims_deleted_cache_file(self):
+        path = os.path.join(self.make_tmpdir(), 'cache')
+        self.last_cache = arv_put.ResumeCache(path)
+        self.last_cache.save(['long', 'long', 'list'])
+        os.unlink(path)
+        self.last_cache.save(['test', 'list'])
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(['test', 'list'], self.last_cache.load())
+        self.assertRaises(arv_put.ResumeCacheConflict,
+                          arv_put.ResumeCache, path)
+
     def test_cache_is_locked(self):
         with tempfile.NamedTemporaryFile() as cachefile:
             cache = arv_put.ResumeCache(cachefile.name)
@@ -330,6 +360,29 @@ class ArvPutUploadJobTest(run_test_server.TestCaseWithServers,
             self.assertEqual(3, cwriter_new.bytes_skipped)
             self.assertEqual(3, cwriter_new.bytes_written)
 
+    def test_checkpoint_rewritten_only_when_state_changes(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'foo')
+            f.flush()
+            cwriter = arv_put.ArvPutUploadJob([f.name])
+            cwriter.start(save_collection=False)
+            try:
+                # Every checkpoint rewrite replaces the cache file via
+                # rename, so a stable inode proves the rewrite was skipped.
+                cwriter._save_state()
+                cache_ino = os.stat(cwriter._cache_filename).st_ino
+                cwriter._save_state()
+                self.assertEqual(cache_ino,
+                                 os.stat(cwriter._cache_filename).st_ino)
+                # A state change must still be written out.
+                with cwriter._state_lock:
+                    cwriter._state['manifest'] = None
+                cwriter._save_state()
+                self.assertNotEqual(cache_ino,
+                                    os.stat(cwriter._cache_filename).st_ino)
+            finally:
+                cwriter.destroy_cache()
+
     def make_progress_tester(self):
         progression = []
         def record_func(written, expected):